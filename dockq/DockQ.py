@@ -95,7 +95,9 @@ def capri_class_DockQ(DockQ,capri_peptide=False):
         return 'Undef'
 
 
-def calc_DockQ(model,native,use_CA_only=False,capri_peptide=False):
+def calc_DockQ(model,native,use_CA_only=False,capri_peptide=False,sample_model=None,ref_model=None):
+    # sample_model/ref_model: already parsed Bio.PDB models of model/native, skips parsing the files again.
+    # The files are still needed by the fnat program. Note that sample_model is superimposed in place.
     
 #    exec_path=os.path.dirname(os.path.abspath(sys.argv[0]))    
     exec_path=os.path.dirname(os.path.abspath(__file__))
@@ -133,13 +135,14 @@ def calc_DockQ(model,native,use_CA_only=False,capri_peptide=False):
     pdb_parser = Bio.PDB.PDBParser(QUIET = True)
 
     # Get the structures
-    ref_structure = pdb_parser.get_structure("reference", native)
-    sample_structure = pdb_parser.get_structure("model", model)
-
     # Use the first model in the pdb-files for alignment
     # Change the number 0 if you want to align to another structure
-    ref_model    = ref_structure[0]
-    sample_model = sample_structure[0]
+    if ref_model is None:
+        ref_structure = pdb_parser.get_structure("reference", native)
+        ref_model    = ref_structure[0]
+    if sample_model is None:
+        sample_structure = pdb_parser.get_structure("model", model)
+        sample_model = sample_structure[0]
 
     # Make a list of the atoms (in the structures) you wish to align.
     # In this case we use CA atoms whose index is in the specified range
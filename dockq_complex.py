@@ -7,15 +7,29 @@ import random
 import pandas as pd
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
 
+from dataclasses import dataclass
 from datetime import datetime
+from pathlib import Path
 from Bio import BiopythonWarning
 from Bio.PDB import PDBParser
-from Bio.PDB.PDBIO import PDBIO
+from Bio.PDB.Structure import Structure
 from Bio.PDB.Model import Model
 from Bio.PDB.Residue import Residue
 from Bio.PDB.Chain import Chain
+from Bio.PDB.Atom import Atom, DisorderedAtom
 from dockq.DockQ import calc_DockQ
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    import gemmi
+except ImportError:
+    gemmi = None
 warnings.simplefilter('ignore', FutureWarning)
 warnings.simplefilter('ignore', BiopythonWarning)
 
@@ -26,97 +40,164 @@ THREE_TO_ONE ={'VAL':'V', 'ILE':'I', 'LEU':'L', 'GLU':'E', 'GLN':'Q', \
     'GLY':'G', 'PRO':'P', 'CYS':'C', 'UNK': 'X', 'SEC': 'U', 'PYL': 'O'} # SEC 硒代半胱氨酸， PYL 吡咯赖氨酸
 
 def get_seq(obj):
-    seq = ''
-    for i in obj.get_residues():
-        if 'CA' in i:
-            seq += THREE_TO_ONE.get(i.resname, 'X')
-        else:
-            seq += 'X'
-
-    return seq
+    _get = THREE_TO_ONE.get
+    return ''.join(_get(i.resname, 'X') if 'CA' in i else 'X' for i in obj.get_residues())
+
+
+def _read_model_gemmi(path, structure_id):
+    '''
+    Bio.PDB Model filled from gemmi, or None when the file has a repeated residue id or atom name
+    (point mutations, an altloc next to a blank altloc) that PDBParser resolves into disordered entities.
+    '''
+    st = gemmi.read_structure(str(path))
+    structure = Structure(structure_id)
+    model = Model(0)
+    structure.add(model)
+    for gchain in st[0]:
+        # gemmi gives a blank chain id as '', PDBParser keeps the column as ' '
+        chain = Chain(gchain.name or ' ')
+        model.add(chain)
+        for gres in gchain:
+            if gres.het_flag == 'H':
+                hetfield = 'W' if gres.name in ('HOH', 'WAT') else f'H_{gres.name}'
+            else:
+                hetfield = ' '
+            res_id = (hetfield, gres.seqid.num, gres.seqid.icode)
+            if res_id in chain.child_dict:
+                return None
+            res = Residue(res_id, gres.name, gres.segment.ljust(4))
+            chain.add(res)
+            res_full_id = res.get_full_id()
+            for gatom in gres:
+                pos = gatom.pos
+                altloc = gatom.altloc if gatom.altloc != '\0' else ' '
+                atom = Atom(gatom.name, np.array((pos.x, pos.y, pos.z), dtype=np.float32), gatom.b_iso, gatom.occ,
+                            altloc, gatom.padded_name().ljust(4), gatom.serial, gatom.element.name.upper())
+                known = res.child_dict.get(atom.id)
+                if altloc != ' ':
+                    # alternative locations are wrapped the same way as PDBParser does
+                    if known is None:
+                        known = DisorderedAtom(atom.id)
+                        res.add(known)
+                        res.flag_disordered()
+                    elif not known.is_disordered():
+                        return None
+                    known.disordered_add(atom)
+                    continue
+                if known is not None:
+                    return None
+                atom.parent = res
+                atom.full_id = res_full_id + ((atom.id, altloc),)
+                res.child_list.append(atom)
+                res.child_dict[atom.id] = atom
+    return model
+
+
+def read_model(path, structure_id='x'):
+    '''
+    First model of a pdb file as a Bio.PDB Model. With gemmi installed, the file is tokenized in C
+    and the Bio.PDB entities are filled directly, skipping the per-atom bookkeeping of PDBParser.
+    Files with repeated residues or atoms go through PDBParser.
+    '''
+    model = _read_model_gemmi(path, structure_id) if gemmi is not None else None
+    if model is None:
+        model = PDBParser(QUIET=True).get_structure(structure_id, path)[0]
+    return model
 
 
 def parse_chain(chain):
-    seq = ''
-    cals = []
-    heavls = []
+    residues = [res for res in chain.get_residues() if res.id[0] == ' ']
+
+    # walk the residues in file order, a forward jump in numbering leaves a gap of 'X' before the residue,
+    # other steps (insertion codes, restarts, numbering from 0 or below) simply append it
+    positions = []
+    gaps = []  # (position in seq, residue number) of each gap
+    pos = -1
     last_res_idx = 0
-    gap_positions = []
-    for res in chain.get_residues():
-        if res.id[0] != ' ':
-            continue
-        
+    for res in residues:
         res_idx = int(res.id[1])
-        
         delta_idx = res_idx - last_res_idx
-        gap_positions.extend(list(range(last_res_idx + 1, res_idx)))
-        if delta_idx != 1:
-            seq += 'X' * (delta_idx - 1)
-            for _ in range(delta_idx - 1):
-                cals.append([0, 0, 0])
+        if delta_idx > 1:
+            gaps.extend(zip(range(pos + 1, pos + delta_idx), range(last_res_idx + 1, res_idx)))
+        pos += max(delta_idx, 1)
+        positions.append(pos)
         last_res_idx = res_idx
-        
-        resname = THREE_TO_ONE[res.resname] if 'CA' in res else 'X'
-        seq += resname
+    n_res = pos + 1
+
+    # positions never filled stay 'X' with zero CA coords
+    seq = ['X'] * n_res
+    cals = np.zeros((n_res, 3), dtype=np.float32)
+    heavls = []
+    _t2o = THREE_TO_ONE.__getitem__ # unknown residue names with CA still raise KeyError
+    for res, res_pos in zip(residues, positions):
+        resname = _t2o(res.resname) if 'CA' in res else 'X'
         if resname == 'X':
-            cals.append([0, 0, 0])
-        else:
-            for at in res.get_atoms():
-                if at.id == 'CA':
-                    cals.append(at.coord)
-                elif at.element != 'H':
-                    heavls.append(at.coord)
-
-    ca_pos = np.array(cals)
-    heav_pos = np.array(heavls)
-    # print(ca_pos.shape)
-    assert len(seq) == ca_pos.shape[0], (len(seq), ca_pos.shape)
-    mask = np.array([i != 'X' for i in seq], dtype=bool)
-
-    # insert UNK residues at gap positions
-    for gap_position in gap_positions:
-        unk_residue = Residue((' ', gap_position, ' '), 'UNK', 0)
-        chain.insert(gap_position-1, unk_residue) # pos is 0-indexed
-    assert get_seq(chain) == seq, f'{get_seq(chain)}\n{seq}\n'
+            continue
+        seq[res_pos] = resname
+        cals[res_pos] = res['CA'].coord
+        heavls.extend([at.coord for at in res if at.id != 'CA' and at.element != 'H'])
+
+    seq = ''.join(seq)
+    ca_pos = cals
+    heav_pos = np.asarray(heavls, dtype=np.float32).reshape(-1, 3)
+    mask = np.fromiter((i != 'X' for i in seq), dtype=bool, count=len(seq))
+
+    # insert UNK residues at gap positions, in increasing order so each lands at its position in seq
+    for gap_pos, gap_res_idx in gaps:
+        unk_residue = Residue((' ', gap_res_idx, ' '), 'UNK', 0)
+        chain.insert(gap_pos, unk_residue)
+    assert len(chain) == len(seq), f'{len(chain)} residues in chain {chain.id}, {len(seq)} in seq'
     return seq, ca_pos, mask, heav_pos
 
 
-def cal_rmsd(x1, x2, eps = 1e-6):
-    assert x1.shape == x2.shape, (x1.shape, x2.shape)
-    assert x1.shape[-1] == 3
-    return np.sqrt(((x1 - x2) ** 2).sum(-1).mean() + eps)
-
-def kabsch_rmsd(true_atom_pos, pred_atom_pos):
-    r, x = get_optimal_transform(
-        true_atom_pos,
-        pred_atom_pos
-    )
-    aligned_true_atom_pos = true_atom_pos @ r + x
-    return cal_rmsd(aligned_true_atom_pos, pred_atom_pos)
-
-
-def cal_ca_kabsch_rmsd(pred_ca, truth_ca, truth_cids, pm):
-    # truth_ca[chain_id] = [ca_pos, mask, heav_pos]
-    # pred_ca[chain.id] = ca_pos
+@dataclass
+class TruthChain:
+    '''arrays of one ground truth chain, ca and mask are indexed by position in the sequence from parse_chain'''
+    __slots__ = ('ca', 'mask', 'heav', 'ca_masked')  # dataclass(slots=True) needs python 3.10
+    ca: np.ndarray
+    mask: np.ndarray
+    heav: np.ndarray
+    ca_masked: np.ndarray
+
+
+def kabsch_rmsd(true_atom_pos, pred_atom_pos, eps = 1e-6):
+    '''
+    RMSD after optimal superposition from the trace identity
+    |R P - Q|^2 = |P|^2 + |Q|^2 - 2 tr(R^T C), without applying the transform.
+    Summed in float64, the difference of the two large terms loses too much in float32.
+    '''
+    assert true_atom_pos.shape == pred_atom_pos.shape, (true_atom_pos.shape, pred_atom_pos.shape)
+    assert true_atom_pos.shape[-1] == 3
+    P = np.asarray(true_atom_pos, dtype=np.float64)
+    Q = np.asarray(pred_atom_pos, dtype=np.float64)
+    P = P - P.mean(-2, keepdims=True)
+    Q = Q - Q.mean(-2, keepdims=True)
+    _, trace = kabsch_rotation(P, Q, return_trace=True)
+    ssd = max((P * P).sum() + (Q * Q).sum() - 2.0 * trace, 0.0)
+    return np.sqrt(ssd / P.shape[-2] + eps)
+
+
+def cal_ca_kabsch_rmsd(pred_vals, truth_ca_all, masks, pm):
+    # truth_ca_all: masked truth ca_pos of all truth chains, concatenated in the order of masks
+    # pred_vals[i] = ca_pos of the i-th predicted chain
     pred_ca_ls = []
-    truth_ca_ls = []
-    for truth_cid, pred_idx in zip(truth_cids, pm):
-        truth_ca_pos, truth_mask, _ =truth_ca[truth_cid]
-        pred_ca_pos = list(pred_ca.values())[pred_idx]
-        truth_ca_ls.append(truth_ca_pos[truth_mask])
+    for truth_mask, pred_idx in zip(masks, pm):
+        pred_ca_pos = pred_vals[pred_idx]
         pred_ca_ls.append(pred_ca_pos[np.pad(truth_mask, (0, pred_ca_pos.shape[0]-len(truth_mask)))])
-        truth_ca_all = np.concatenate(truth_ca_ls)
-        pred_ca_all = np.concatenate(pred_ca_ls)
+    pred_ca_all = np.concatenate(pred_ca_ls)
     return kabsch_rmsd(truth_ca_all, pred_ca_all)
 
 def get_optimal_transform(src_atoms, tgt_atoms, mask = None):    
     assert src_atoms.shape == tgt_atoms.shape, (src_atoms.shape, tgt_atoms.shape)
     assert src_atoms.shape[-1] == 3
+    # structural coordinates only need single precision, keep them float32 and contiguous for BLAS
+    src_atoms = np.ascontiguousarray(src_atoms, dtype=np.float32)
+    tgt_atoms = np.ascontiguousarray(tgt_atoms, dtype=np.float32)
     if mask is not None:
         assert mask.dtype == bool
         assert mask.shape[-1] == src_atoms.shape[-2]
         if mask.sum() == 0:
-            src_atoms = np.zeros((1, 3)).astype(np.float32)
+            src_atoms = np.zeros((1, 3), dtype=np.float32)
             tgt_atoms = src_atoms
         else:
             src_atoms = src_atoms[mask, :]
@@ -129,7 +210,242 @@ def get_optimal_transform(src_atoms, tgt_atoms, mask = None):
     return r, x
 
 
-def kabsch_rotation(P, Q):
+def _jit(func):
+    '''compile with numba if it is installed, otherwise keep the python function'''
+    if njit is None:
+        return func
+    return njit(cache=True, fastmath=True)(func)
+
+
+@_jit
+def _svd3x3(C):
+    '''
+    SVD of a 3x3 matrix by Jacobi eigenanalysis of C^T C followed by a Givens QR,
+    after McAdams et al. "Computing the Singular Value Decomposition of 3x3
+    matrices with minimal branching and elementary floating point operations".
+    U and V are proper rotations, so the last singular value carries the sign of det(C).
+    Returns U, S, Vt with C = U @ diag(S) @ Vt.
+    '''
+    A = C.T @ C
+    V = np.eye(3)
+    # cyclic Jacobi sweeps on the symmetric matrix C^T C
+    for _ in range(8):
+        off = A[0, 1] * A[0, 1] + A[0, 2] * A[0, 2] + A[1, 2] * A[1, 2]
+        if off < 1e-30 * (A[0, 0] * A[0, 0] + A[1, 1] * A[1, 1] + A[2, 2] * A[2, 2]) + 1e-300:
+            break
+        for p, q in ((0, 1), (0, 2), (1, 2)):
+            if A[p, q] == 0.0:
+                continue
+            theta = (A[q, q] - A[p, p]) / (2.0 * A[p, q])
+            t = 1.0 / (abs(theta) + np.sqrt(theta * theta + 1.0))
+            if theta < 0.0:
+                t = -t
+            c = 1.0 / np.sqrt(t * t + 1.0)
+            s = t * c
+            for k in range(3):
+                akp = A[k, p]
+                akq = A[k, q]
+                A[k, p] = c * akp - s * akq
+                A[k, q] = s * akp + c * akq
+            for k in range(3):
+                apk = A[p, k]
+                aqk = A[q, k]
+                A[p, k] = c * apk - s * aqk
+                A[q, k] = s * apk + c * aqk
+            for k in range(3):
+                vkp = V[k, p]
+                vkq = V[k, q]
+                V[k, p] = c * vkp - s * vkq
+                V[k, q] = s * vkp + c * vkq
+
+    # sort columns of B = C V by decreasing norm, negating one column per swap to keep det(V) = 1
+    B = C @ V
+    for i in range(2):
+        for j in range(2 - i):
+            nj = B[0, j] * B[0, j] + B[1, j] * B[1, j] + B[2, j] * B[2, j]
+            nk = B[0, j+1] * B[0, j+1] + B[1, j+1] * B[1, j+1] + B[2, j+1] * B[2, j+1]
+            if nj < nk:
+                for k in range(3):
+                    b = B[k, j]
+                    B[k, j] = -B[k, j+1]
+                    B[k, j+1] = b
+                    v = V[k, j]
+                    V[k, j] = -V[k, j+1]
+                    V[k, j+1] = v
+
+    # QR decomposition of B with Givens rotations, U accumulates the rotations
+    U = np.eye(3)
+    for i, j in ((0, 1), (0, 2), (1, 2)):
+        a = B[i, i]
+        b = B[j, i]
+        r = np.sqrt(a * a + b * b)
+        if r == 0.0:
+            continue
+        c = a / r
+        s = b / r
+        for k in range(3):
+            bik = B[i, k]
+            bjk = B[j, k]
+            B[i, k] = c * bik + s * bjk
+            B[j, k] = -s * bik + c * bjk
+            uki = U[k, i]
+            ukj = U[k, j]
+            U[k, i] = c * uki + s * ukj
+            U[k, j] = -s * uki + c * ukj
+    S = np.empty(3)
+    for k in range(3):
+        S[k] = B[k, k]
+    return U, S, V.T
+
+
+@_jit
+def _qcp_rotation(C, E0):
+    '''
+    Optimal rotation from the inner product matrix C = P^T Q with Theobald's QCP method:
+    the largest eigenvalue of the 4x4 key matrix is found by Newton iteration on its
+    characteristic polynomial, starting from E0 = (|P|^2 + |Q|^2) / 2, and the eigenvector
+    (a quaternion) is taken from the cofactors of (K - lambda I), see Liu, Agrafiotis & Theobald,
+    J Comput Chem 2010. Returns the rotation and the largest eigenvalue.
+    '''
+    if E0 <= 0.0:
+        return np.eye(3), 0.0
+    Sxx, Sxy, Sxz = C[0, 0], C[0, 1], C[0, 2]
+    Syx, Syy, Syz = C[1, 0], C[1, 1], C[1, 2]
+    Szx, Szy, Szz = C[2, 0], C[2, 1], C[2, 2]
+
+    Sxx2, Syy2, Szz2 = Sxx * Sxx, Syy * Syy, Szz * Szz
+    Sxy2, Syz2, Sxz2 = Sxy * Sxy, Syz * Syz, Sxz * Sxz
+    Syx2, Szy2, Szx2 = Syx * Syx, Szy * Szy, Szx * Szx
+
+    SyzSzymSyySzz2 = 2.0 * (Syz * Szy - Syy * Szz)
+    Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2
+
+    c2 = -2.0 * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2)
+    c1 = 8.0 * (Sxx * Syz * Szy + Syy * Szx * Sxz + Szz * Sxy * Syx
+                - Sxx * Syy * Szz - Syz * Szx * Sxy - Szy * Syx * Sxz)
+
+    SxzpSzx = Sxz + Szx
+    SyzpSzy = Syz + Szy
+    SxypSyx = Sxy + Syx
+    SyzmSzy = Syz - Szy
+    SxzmSzx = Sxz - Szx
+    SxymSyx = Sxy - Syx
+    SxxpSyy = Sxx + Syy
+    SxxmSyy = Sxx - Syy
+    Sxy2Sxz2Syx2Szx2 = Sxy2 + Sxz2 - Syx2 - Szx2
+
+    c0 = (Sxy2Sxz2Syx2Szx2 * Sxy2Sxz2Syx2Szx2
+          + (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2)
+          + (-SxzpSzx * SyzmSzy + SxymSyx * (SxxmSyy - Szz)) * (-SxzmSzx * SyzpSzy + SxymSyx * (SxxmSyy + Szz))
+          + (-SxzpSzx * SyzpSzy - SxypSyx * (SxxpSyy - Szz)) * (-SxzmSzx * SyzmSzy - SxypSyx * (SxxpSyy + Szz))
+          + (SxypSyx * SyzpSzy + SxzpSzx * (SxxmSyy + Szz)) * (-SxymSyx * SyzmSzy + SxzpSzx * (SxxpSyy + Szz))
+          + (SxypSyx * SyzmSzy + SxzmSzx * (SxxmSyy - Szz)) * (-SxymSyx * SyzpSzy + SxzmSzx * (SxxpSyy - Szz)))
+
+    # Newton iteration for the largest root of lambda^4 + c2 lambda^2 + c1 lambda + c0
+    lam = E0
+    for _ in range(50):
+        old = lam
+        x2 = lam * lam
+        b = (x2 + c2) * lam
+        a = b + c1
+        denom = 2.0 * x2 * lam + b + a
+        if denom == 0.0:
+            break
+        lam -= (a * lam + c0) / denom
+        if abs(lam - old) < abs(1e-11 * lam):
+            break
+
+    a11 = SxxpSyy + Szz - lam
+    a12 = SyzmSzy
+    a13 = -SxzmSzx
+    a14 = SxymSyx
+    a21 = SyzmSzy
+    a22 = SxxmSyy - Szz - lam
+    a23 = SxypSyx
+    a24 = SxzpSzx
+    a31 = a13
+    a32 = a23
+    a33 = Syy - Sxx - Szz - lam
+    a34 = SyzpSzy
+    a41 = a14
+    a42 = a24
+    a43 = a34
+    a44 = Szz - SxxpSyy - lam
+    a3344_4334 = a33 * a44 - a43 * a34
+    a3244_4234 = a32 * a44 - a42 * a34
+    a3243_4233 = a32 * a43 - a42 * a33
+    a3143_4133 = a31 * a43 - a41 * a33
+    a3144_4134 = a31 * a44 - a41 * a34
+    a3142_4132 = a31 * a42 - a41 * a32
+    a1324_1423 = a13 * a24 - a14 * a23
+    a1224_1422 = a12 * a24 - a14 * a22
+    a1223_1322 = a12 * a23 - a13 * a22
+    a1124_1421 = a11 * a24 - a14 * a21
+    a1123_1321 = a11 * a23 - a13 * a21
+    a1122_1221 = a11 * a22 - a12 * a21
+
+    # the eigenvector is any non-vanishing row of the adjugate of (K - lambda I)
+    threshold = 1e-6 * E0 ** 6 + 1e-300
+    for row in range(4):
+        if row == 0:
+            q1 = a22 * a3344_4334 - a23 * a3244_4234 + a24 * a3243_4233
+            q2 = -a21 * a3344_4334 + a23 * a3144_4134 - a24 * a3143_4133
+            q3 = a21 * a3244_4234 - a22 * a3144_4134 + a24 * a3142_4132
+            q4 = -a21 * a3243_4233 + a22 * a3143_4133 - a23 * a3142_4132
+        elif row == 1:
+            q1 = a12 * a3344_4334 - a13 * a3244_4234 + a14 * a3243_4233
+            q2 = -a11 * a3344_4334 + a13 * a3144_4134 - a14 * a3143_4133
+            q3 = a11 * a3244_4234 - a12 * a3144_4134 + a14 * a3142_4132
+            q4 = -a11 * a3243_4233 + a12 * a3143_4133 - a13 * a3142_4132
+        elif row == 2:
+            q1 = a42 * a1324_1423 - a43 * a1224_1422 + a44 * a1223_1322
+            q2 = -a41 * a1324_1423 + a43 * a1124_1421 - a44 * a1123_1321
+            q3 = a41 * a1224_1422 - a42 * a1124_1421 + a44 * a1122_1221
+            q4 = -a41 * a1223_1322 + a42 * a1123_1321 - a43 * a1122_1221
+        else:
+            q1 = a32 * a1324_1423 - a33 * a1224_1422 + a34 * a1223_1322
+            q2 = -a31 * a1324_1423 + a33 * a1124_1421 - a34 * a1123_1321
+            q3 = a31 * a1224_1422 - a32 * a1124_1421 + a34 * a1122_1221
+            q4 = -a31 * a1223_1322 + a32 * a1123_1321 - a33 * a1122_1221
+        qsqr = q1 * q1 + q2 * q2 + q3 * q3 + q4 * q4
+        if qsqr > threshold:
+            break
+    else:
+        # degenerate eigenvector (e.g. collinear points), fall back to the SVD
+        U, S, Vt = _svd3x3(C.copy())
+        return U @ Vt, S[0] + S[1] + S[2]
+
+    normq = np.sqrt(qsqr)
+    q1 /= normq
+    q2 /= normq
+    q3 /= normq
+    q4 /= normq
+
+    a2 = q1 * q1
+    x2 = q2 * q2
+    y2 = q3 * q3
+    z2 = q4 * q4
+    xy = q2 * q3
+    az = q1 * q4
+    zx = q4 * q2
+    ay = q1 * q3
+    yz = q3 * q4
+    ax = q1 * q2
+
+    R = np.empty((3, 3))
+    R[0, 0] = a2 + x2 - y2 - z2
+    R[0, 1] = 2.0 * (xy + az)
+    R[0, 2] = 2.0 * (zx - ay)
+    R[1, 0] = 2.0 * (xy - az)
+    R[1, 1] = a2 - x2 + y2 - z2
+    R[1, 2] = 2.0 * (yz + ax)
+    R[2, 0] = 2.0 * (zx + ay)
+    R[2, 1] = 2.0 * (yz - ax)
+    R[2, 2] = a2 - x2 - y2 + z2
+    return R, lam
+
+
+def kabsch_rotation(P, Q, return_trace=False):
     """
     Using the Kabsch algorithm with two sets of paired point P and Q, centered
     around the centroid. Each vector set is represented as an NxD
@@ -150,6 +466,9 @@ def kabsch_rotation(P, Q):
     -------
     U : matrix
         Rotation matrix (D,D)
+    trace : float
+        tr(U^T C), the sum of the sign-corrected singular values,
+        only returned with return_trace=True
     """
 
     # Computation of the covariance matrix
@@ -161,58 +480,179 @@ def kabsch_rotation(P, Q):
     # right-handed coordinate system.
     # And finally calculating the optimal rotation matrix U
     # see http://en.wikipedia.org/wiki/Kabsch_algorithm
-    V, _, W = np.linalg.svd(C)
+    if njit is not None:
+        # QCP gives the same rotation without any SVD
+        E0 = 0.5 * float((P * P).sum() + (Q * Q).sum())
+        U, lam = _qcp_rotation(np.asarray(C, dtype=np.float64), E0)
+        U = U.astype(C.dtype)
+        return (U, lam) if return_trace else U
+
+    V, S, W = np.linalg.svd(C)
     d = (np.linalg.det(V) * np.linalg.det(W)) < 0.0
 
     if d:
         V[:, -1] = -V[:, -1]
+        S[-1] = -S[-1]
 
     # Create Rotation matrix U
     U = V @ W
-    return U
-
-
-def get_mean_pred(pred_ca_pos, mask, pred_cid, truth_cid, df):
-    assert pred_ca_pos.shape[-1] == 3
-    if pred_cid not in df.pred_cid[df.truth_cid == truth_cid].values[0]:
-        return np.array([1e9, 1e9, 1e9]).reshape(1, -1)
-    else:
-        mask = np.pad(mask, (0, pred_ca_pos.shape[0]-len(mask))) # pad mask to pred residue length
-        return pred_ca_pos[mask].mean(0, keepdims=True)
+    return (U, float(S.sum())) if return_trace else U
 
 
 def find_optimal_permutation(x_mean_pred, x_mean_truth):
     '''Find Optimal Permutation'''
     assert x_mean_pred.shape[-1] == 3, x_mean_pred.shape
     assert x_mean_truth.shape[-1] == 3, x_mean_truth.shape
-    d_kl = np.sqrt(((x_mean_pred - x_mean_truth[None]) ** 2).sum(-1))
-    p_l = []
-    for l in range(d_kl.shape[1]):
-        d_l = d_kl[:, l]
-        best_idx = d_l.argmin()
-        p_l.append(best_idx)
-        d_kl[best_idx, :] = 1e9
-    return p_l
-
-def has_contact(chain1, chain2):
-    '''defined as any heavy atom of one chain being within 5A of any heavy atom of the other chain'''
-    d = np.expand_dims(chain1, 1) - chain2[None, :]
-    dist = np.sqrt((d ** 2).sum(-1))
-    return (dist <= 5).any()
+    d_kl = ((x_mean_pred - x_mean_truth[None]) ** 2).sum(-1)
+    # optimal assignment minimizing the summed centroid distances
+    row_ind, col_ind = linear_sum_assignment(np.sqrt(d_kl))
+    return row_ind[np.argsort(col_ind)].tolist()
+
+def contact_pairs(heavs):
+    '''indices (i, j), i < j, of all chain pairs in contact given the heavy atom coordinates of each chain'''
+    pairs = [(i, j) for i in range(len(heavs) - 1) for j in range(i + 1, len(heavs))]
+    # contact is any heavy atom of one chain within 5A of any heavy atom of the other chain,
+    # one tree per chain built once, only atoms of different chains are compared
+    trees = [cKDTree(h) for h in heavs]
+    return {(i, j) for i, j in pairs if trees[i].count_neighbors(trees[j], r=5.0) > 0}
 
 
 def rm_masked_res(chain, mask):
+    # residue ids of a chain are unique, fill the children at once instead of Chain.add per residue
     chain1 = Chain(chain.id)
-    for res, m in zip(chain.child_list, mask):
-        if m:
-            chain1.add(res)
+    kept = [res for res, m in zip(chain.child_list, mask) if m]
+    chain1.child_list = kept
+    chain1.child_dict = {res.id: res for res in kept}
+    for res in kept:
+        res.set_parent(chain1)  # also resets the cached full_id
     return chain1
 
+PDB_ATOM_FORMAT = '%s%5i %-4s%1s%3s %1s%4i%1s   %8.3f%8.3f%8.3f%6s%6.2f      %4s%2s  \n'
+PDB_TER_FORMAT = 'TER   %5i      %3s %1s%4i%1s                                                      \n'
+
+def write_pdb(model, path):
+    '''write all chains of a model into a pdb file in one go, in the same layout as PDBIO'''
+    lines = []
+    atom_number = 1
+    for chain in model:
+        written = False
+        for residue in chain.get_unpacked_list():
+            hetfield, resseq, icode = residue.id
+            record_type = 'ATOM  ' if hetfield == ' ' else 'HETATM'
+            resname = residue.resname
+            for atom in residue.get_unpacked_list():
+                element = atom.element.strip().upper() if atom.element else ''
+                name = atom.fullname.strip()
+                if len(name) < 4 and name[:1].isalpha() and len(element) < 2:
+                    name = ' ' + name
+                x, y, z = atom.coord
+                # a blank occupancy column is read as None and written back blank, as PDBIO does
+                occupancy = '%6.2f' % atom.occupancy if atom.occupancy is not None else ' ' * 6
+                lines.append(PDB_ATOM_FORMAT % (record_type, atom_number, name, atom.altloc, resname, chain.id, resseq, icode,
+                                                x, y, z, occupancy, atom.bfactor, residue.segid, element))
+                atom_number += 1
+                written = True
+        if written:
+            lines.append(PDB_TER_FORMAT % (atom_number, resname, chain.id, resseq, icode))
+    lines.append('END   \n')
+    with open(path, 'w') as f:
+        f.write(''.join(lines))
+
+
+def dump_pair(chain_i, chain_j, path):
+    '''model of a chain pair, written to path for the fnat binary'''
+    model = Model(0)
+    model.add(chain_i)
+    model.add(chain_j)
+    write_pdb(model, path)
+    return model
+
+
 def show_model(model):
-    return [len(list(chain)) for chain in model.get_chains()]
+    return [len(chain) for chain in model.get_chains()]
+
+
+def cal_dockq_pair(pred, truth_chain, truth_masks, task):
+    '''DockQ of one chain pair in contact, task = (cid_ti, cid_tj, cid_pi, cid_pj, file_pred, file_truth, extra)'''
+    cid_ti, cid_tj, cid_pi, cid_pj, file_pred, file_truth, extra = task
+    mask_i = truth_masks[cid_ti]
+    mask_j = truth_masks[cid_tj]
+    model_p = dump_pair(rm_masked_res(pred.child_dict[cid_pi], mask_i),
+                        rm_masked_res(pred.child_dict[cid_pj], mask_j), file_pred)
+    chain_i = truth_chain[cid_ti].copy()
+    chain_i.id = cid_pi
+    chain_j = truth_chain[cid_tj].copy()
+    chain_j.id = cid_pj
+    model_t = dump_pair(rm_masked_res(chain_i, mask_i), rm_masked_res(chain_j, mask_j), file_truth)
+    print(f'seq len for chain {cid_ti} and {cid_tj}: {show_model(model_t)} (truth), {show_model(model_p)} (pred)')
+    # both models are cut with the truth masks, compare the sequences of truth and prediction
+    seq_t, seq_p = get_seq(model_t), get_seq(model_p)
+    assert seq_t == seq_p, f'\n{seq_t}\n{seq_p}\n'
+
+    # calc_DockQ superimposes model_p in place, restore the coordinates of atoms shared with the prediction,
+    # alternate locations included since a disordered atom moves all of its children
+    atoms = _unpacked_atoms(model_p)
+    coords = [atom.coord for atom in atoms]
+    try:
+        info = calc_DockQ(file_pred, file_truth, sample_model=model_p, ref_model=model_t)
+    finally:
+        for atom, coord in zip(atoms, coords):
+            atom.coord = coord
+    info.update(extra)
+    return info
+
+
+def _unpacked_atoms(chains):
+    return [atom for chain in chains for res in chain.get_unpacked_list() for atom in res.get_unpacked_list()]
+
+
+_worker = {}
+
+def _init_worker(pred, truth_chain, truth_masks, shm_spec):
+    '''
+    Pool initializer: the structures arrive once per worker without coordinates,
+    which are attached as read-only views of the shared memory block.
+    '''
+    shm_name, shape, dtype = shm_spec
+    shm = shared_memory.SharedMemory(name=shm_name)
+    coords = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    coords.flags.writeable = False
+    for atom, coord in zip(_unpacked_atoms(list(pred) + list(truth_chain.values())), coords):
+        atom.coord = coord
+    _worker.update(shm=shm, pred=pred, truth_chain=truth_chain, truth_masks=truth_masks)
 
 
-def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mode=False):
+def _run_dockq(task):
+    '''DockQ of one chain pair inside a pool worker, kept at module level so that it can be pickled'''
+    return cal_dockq_pair(_worker['pred'], _worker['truth_chain'], _worker['truth_masks'], task)
+
+
+def pool_dockq(pred, truth_chain, truth_masks, tasks, ncpu):
+    '''evaluate chain pairs in a process pool, sharing the atom coordinates through shared memory'''
+    atoms = _unpacked_atoms(list(pred) + list(truth_chain.values()))
+    coords = np.array([atom.coord for atom in atoms], dtype=np.float32).reshape(-1, 3)
+    shm = shared_memory.SharedMemory(create=True, size=max(coords.nbytes, 1))
+    try:
+        np.ndarray(coords.shape, dtype=coords.dtype, buffer=shm.buf)[:] = coords
+        shm_spec = (shm.name, coords.shape, coords.dtype.str)
+        # the structures are sent to the workers without coordinates while the pool starts
+        orig_coords = [atom.coord for atom in atoms]
+        for atom in atoms:
+            atom.coord = None
+        try:
+            pool = mp.Pool(processes=min(ncpu, len(tasks)), initializer=_init_worker,
+                           initargs=(pred, truth_chain, truth_masks, shm_spec))
+        finally:
+            for atom, coord in zip(atoms, orig_coords):
+                atom.coord = coord
+        with pool:
+            return pool.map(_run_dockq, tasks)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mode=False, ncpu=1):
 
     timestr = datetime.now().strftime('%Y%m%d%H%M%S')
     if key is None:
@@ -228,10 +668,9 @@ def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mod
     tmp_dir = f'_tmp/{pdb_id}_{key}'
     os.makedirs(tmp_dir, exist_ok=True)
     try:
-        parser = PDBParser(QUIET=True)
         chain_dict = {}
         pred_ca = {}
-        pred = parser.get_structure('pred', pred_pdb_path)[0]
+        pred = read_model(pred_pdb_path, 'pred')
         for chain in pred.get_chains():
             seq, ca_pos, _, _ = parse_chain(chain)
             pred_ca[chain.id] = ca_pos
@@ -241,6 +680,9 @@ def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mod
             else:
                 chain_dict[seq] = [chain.id]
             
+        pred_cids = list(pred_ca.keys())
+        pred_vals = list(pred_ca.values())
+
         ls = []
         for k, v in chain_dict.items():
             ls.append([''.join(v), len(k), k])
@@ -256,13 +698,13 @@ def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mod
 
         # get truth pdb chains list
         if os.path.isfile(truth_pdb_path):
-            truth_pdbs = parser.get_structure('truth', truth_pdb_path)[0].child_list
+            truth_pdbs = read_model(truth_pdb_path, 'truth').child_list
         elif os.path.isdir(truth_pdb_path):
             if pdb_id is None:
                 raise ValueError('"pdb_id" should be provided when "truth_pdb_path" is a directory.')
-            truth_pdbs = [i.strip() for i in os.popen(f'find {truth_pdb_path} -name {pdb_id}*pdb').readlines()]
+            truth_pdbs = sorted(str(i) for i in Path(truth_pdb_path).rglob(f'{pdb_id}*pdb'))
             truth_pdbs = [i for i in truth_pdbs if not os.path.samefile(i, pred_pdb_path)]
-            truth_pdbs = [parser.get_structure('truth', i)[0].child_list[0] for i in truth_pdbs]
+            truth_pdbs = [read_model(i, 'truth').child_list[0] for i in truth_pdbs]
         assert len(truth_pdbs) == len(pred.child_list), f'The number of ground truth chains is not equal to that of prediction: {len(truth_pdbs), len(pred.child_list)}'
         
         for i, chain in enumerate(truth_pdbs):
@@ -270,7 +712,7 @@ def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mod
             chain_id = PDB_CHAIN_IDS[i]
             truth_chain[chain_id] = chain
             seq, ca_pos, mask, heav_pos = parse_chain(chain)
-            truth_ca[chain_id] = [ca_pos, mask, heav_pos]
+            truth_ca[chain_id] = TruthChain(ca_pos, mask, heav_pos, np.ascontiguousarray(ca_pos[mask]))
 
             for i, row in df_pred.iterrows():
                 if row.seq_len < len(seq):
@@ -291,25 +733,40 @@ def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mod
             df.to_csv(f'{tmp_dir}/{pdb_id}_info.tsv', sep='\t', index=False)
 
         truth_cids = df.truth_cid
+        # single-cell lookups by truth chain id, the first row of each truth chain wins as with .values[0]
+        df_first = df.drop_duplicates('truth_cid')
+        tp_map = dict(zip(df_first.truth_cid.values, df_first.pred_cid.values))
+        tpath_map = dict(zip(df_first.truth_cid.values, df_first.truth_path.values))
         anchor_truth = truth_cids[0]
         
         anchors_pred = list(df.pred_cid[0])
-        masks = [truth_ca[i][1] for i in truth_cids]
+        masks = [truth_ca[i].mask for i in truth_cids]
+        # masked truth coordinates do not depend on the anchor, only the transform does
+        truth_ca_masked = [truth_ca[i].ca_masked for i in truth_cids]
+        truth_ca_all = np.concatenate(truth_ca_masked)
+        truth_ca_mean = np.concatenate([x.mean(0, keepdims=True) for x in truth_ca_masked])
         # x_mean_pred: (num_pred_chain, num_truth_chain, 3)
-        x_mean_pred = np.concatenate([np.concatenate([get_mean_pred(pred_ca_pos, mask, pred_cid, truth_cid, df) for pred_cid, pred_ca_pos in pred_ca.items()])[:, None] for truth_cid, mask in zip(truth_cids, masks)], 1)
+        # pad pred coordinates and truth masks to a common length, masked means of all pairs in one einsum
+        n_max = max([len(i) for i in pred_vals] + [len(i) for i in masks])
+        pred_stack = np.stack([np.pad(i, ((0, n_max - len(i)), (0, 0))) for i in pred_vals])
+        mask_stack = np.stack([np.pad(i, (0, n_max - len(i))) for i in masks]).astype(pred_stack.dtype)
+        x_mean_pred = np.einsum('kn,pnm->pkm', mask_stack, pred_stack) / mask_stack.sum(-1)[None, :, None]
+        # pred chains with a different sequence can never be assigned to the truth chain
+        same_seq = np.array([[pred_cid in tp_map[truth_cid] for truth_cid in truth_cids] for pred_cid in pred_cids])
+        x_mean_pred[~same_seq] = 1e9
 
         # print(x_mean_pred.shape)
         pm_best = []
         rmsd_min = 1e9
         for anchor_pred in anchors_pred:
-            ca_t, mask, _ = truth_ca[anchor_truth]
+            ca_t, mask = truth_ca[anchor_truth].ca, truth_ca[anchor_truth].mask
             ca_p = pred_ca[anchor_pred][:len(mask)]
             r, t = get_optimal_transform(ca_t, ca_p, mask)
-            x_mean_truth = np.concatenate([(truth_ca[i][0][truth_ca[i][1]] @ r + t).mean(0, keepdims=True) for i in truth_cids])
+            # the mean commutes with the rigid transform
+            x_mean_truth = truth_ca_mean @ r + t
             # print(x_mean_truth.shape)
             pm = find_optimal_permutation(x_mean_pred, x_mean_truth)
-            # rmsd = cal_rmsd(x_mean_truth, x_mean_pred[pm, range(len(pm))])
-            rmsd = cal_ca_kabsch_rmsd(pred_ca, truth_ca, truth_cids, pm)
+            rmsd = cal_ca_kabsch_rmsd(pred_vals, truth_ca_all, masks, pm)
             print([anchor_truth, anchor_pred, pm, rmsd])
             if rmsd < rmsd_min:
                 rmsd_min = rmsd
@@ -317,55 +774,46 @@ def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mod
 
 
         match_table = {}
-        for cid_t, cid_p in zip(truth_cids, np.array(list(pred_ca.keys()))[pm_best]):
-            cids_p = df.pred_cid[df.truth_cid == cid_t].values[0]
+        for cid_t, cid_p in zip(truth_cids, np.array(pred_cids)[pm_best]):
+            cids_p = tp_map[cid_t]
             assert cid_p in cids_p, (cid_p, cids_p)
             match_table[cid_t] = cid_p
         if save_mode:
             with open(f'{tmp_dir}/{pdb_id}_match_table.tsv', 'w') as f:
-                f.writelines([f'{df.truth_path[df.truth_cid == k].values[0]}\t{v}\n' for k, v in match_table.items()])
+                f.writelines([f'{tpath_map[k]}\t{v}\n' for k, v in match_table.items()])
 
 
         n_chains = len(match_table)
-        dockqls = []
+        match_cids = list(match_table.keys())
+        contacts = contact_pairs([truth_ca[cid].heav for cid in match_cids])
+        tasks = []
         for i in range(n_chains - 1):
             for j in range(i + 1, n_chains):
-                cid_ti = list(match_table.keys())[i]
-                cid_tj = list(match_table.keys())[j]
-                cont = has_contact(truth_ca[cid_ti][2], truth_ca[cid_tj][2])
-                if not cont:
+                if (i, j) not in contacts:
                     continue
+                cid_ti = match_cids[i]
+                cid_tj = match_cids[j]
                 cid_pi = match_table[cid_ti]
                 cid_pj = match_table[cid_tj]
                 file_pred = f'{tmp_dir}/pred_{cid_pi}_{cid_pj}.pdb'
                 file_truth = f'{tmp_dir}/truth_{cid_pi}_{cid_pj}.pdb'
-                mask_i = truth_ca[cid_ti][1]
-                mask_j = truth_ca[cid_tj][1]
-                io = PDBIO()
-                model_p = Model(0)
-                model_p.add(rm_masked_res(pred.child_dict[cid_pi], mask_i))
-                model_p.add(rm_masked_res(pred.child_dict[cid_pj], mask_j))
-                io.set_structure(model_p)
-                io.save(file_pred)
-                model_t = Model(0)
-                chain_i = truth_chain[cid_ti].copy()
-                chain_i.id = cid_pi
-                chain_j = truth_chain[cid_tj].copy()
-                chain_j.id = cid_pj
-                model_t.add(rm_masked_res(chain_i, mask_i))
-                model_t.add(rm_masked_res(chain_j, mask_j))
-                io.set_structure(model_t)
-                io.save(file_truth)
-                print(f'seq len for chain {cid_ti} and {cid_tj}: {show_model(model_t)} (truth), {show_model(model_p)} (pred)')
-                assert get_seq(model_t) == get_seq(model_p), f'\n{get_seq(model_t)}\n{get_seq(model_p)}\n'
-                info = calc_DockQ(file_pred, file_truth)
-                info['pdb_id'] = pdb_id
-                info['pred_i'] = cid_pi
-                info['pred_j'] = cid_pj
-                info['truth_i'] = df.truth_path[df.truth_cid == cid_ti].values[0]
-                info['truth_j'] = df.truth_path[df.truth_cid == cid_tj].values[0]
-                dockqls.append(pd.DataFrame(info, index=[0]))
-        
+                extra = {
+                    'pdb_id': pdb_id,
+                    'pred_i': cid_pi,
+                    'pred_j': cid_pj,
+                    'truth_i': tpath_map[cid_ti],
+                    'truth_j': tpath_map[cid_tj],
+                }
+                tasks.append((cid_ti, cid_tj, cid_pi, cid_pj, file_pred, file_truth, extra))
+
+        # chain pairs are independent, evaluate them in parallel for complexes with more than one interface
+        truth_masks = {cid: truth_ca[cid].mask for cid in match_cids}
+        if ncpu > 1 and n_chains >= 3 and len(tasks) > 1:
+            infos = pool_dockq(pred, truth_chain, truth_masks, tasks, ncpu)
+        else:
+            infos = [cal_dockq_pair(pred, truth_chain, truth_masks, task) for task in tasks]
+        dockqls = [pd.DataFrame(info, index=[0]) for info in infos]
+
         if len(dockqls) == 0:
             print(f'No contact: {pdb_id}')
             return None
@@ -377,7 +825,7 @@ def cal_dockq_pdb(pred_pdb_path, truth_pdb_path, pdb_id=None, key=None, save_mod
             dockqdf.to_csv(f'{tmp_dir}/{pdb_id}_dockq_info.tsv', sep='\t', index=False)
         dockq = dockqdf.DockQ.mean()
         dockq = round(dockq, 5)
-        rmsd = round(rmsd, 5)
+        rmsd = round(float(rmsd), 5)
         return dockq, rmsd
     # except:
     #     return None, None
@@ -393,8 +841,9 @@ if __name__ == '__main__':
     parser.add_argument('--pdb_id', type=str, default=None, help='PDB id, if "truth_pdb_path" is a directory, all files in "truth_pdb_path" with the pattern "pdb_id***pdb" (excluding pred_pdb_path) will be recognized as ground truth pdbs')
     parser.add_argument('--key', type=str,default=None, help='output directory identifier')
     parser.add_argument('--save_mode', action='store_true', help='it will save intermediate results with this mode on')
+    parser.add_argument('--ncpu', type=int, default=1, help='number of processes used to calculate DockQ of chain pairs in parallel')
     args = parser.parse_args()
     
 
-    dockq, rmsd = cal_dockq_pdb(args.pred_pdb_path, args.truth_pdb_path, args.pdb_id, args.key, args.save_mode)
+    dockq, rmsd = cal_dockq_pdb(args.pred_pdb_path, args.truth_pdb_path, args.pdb_id, args.key, args.save_mode, args.ncpu)
     print(f'RMSD: {rmsd}\nAveraged DockQ: {dockq}')
\ No newline at end of file